@@ -1,13 +1,22 @@
+import io
 import os
+import pickle
+import tempfile
 import zipfile
-import shutil
 import geopandas as gpd
 import pandas as pd
 import numpy as np
+import pyogrio
+import shapely
 import streamlit as st
 
+from concurrent.futures import ThreadPoolExecutor
+from pyproj import Transformer
+from scipy.spatial import cKDTree
 from shapely.geometry import Point
 
+gpd.options.io_engine = "pyogrio"
+
 # === Streamlit Setup ===
 st.set_page_config(page_title="Optimal Facility Siting", layout="wide")
 st.title("📍 Optimal Facility Siting App")
@@ -15,8 +24,11 @@ st.markdown("Upload a **.zip shapefile** of your target area to analyze suitabil
 
 # === Constants ===
 UPLOAD_FOLDER = "uploads"
-EXTRACT_FOLDER = "uploads/extracted"
-os.makedirs(EXTRACT_FOLDER, exist_ok=True)
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+INFRA_CACHE = os.path.join(UPLOAD_FOLDER, ".infra_cache.pkl")
+
+# Weights for density, health, police and roads scores, in that order
+SCORE_WEIGHTS = np.array([0.4, 0.2, 0.2, 0.2], dtype=np.float32)
 
 INFRASTRUCTURE_FILES = {
     'health': 'dataset/Health Facilities.shp',
@@ -26,109 +38,250 @@ INFRASTRUCTURE_FILES = {
 
 # === Helper Functions ===
 
-def extract_zip(zip_file, extract_to):
-    with zipfile.ZipFile(zip_file, 'r') as z:
-        z.extractall(extract_to)
+def find_shapefile(zip_bytes):
+    # Only the ZIP's central directory is read; nothing is extracted
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as z:
+        for name in z.namelist():
+            if name.endswith('.shp') and not name.startswith('__MACOSX/'):
+                return name
+    return None
+
+@st.cache_resource
+def utm_transformer():
+    # Built once per process for any low-level reprojection; the dummy to_crs
+    # warms the transformer geopandas memoises for its own to_crs calls
+    gpd.GeoSeries([Point(0, 0)], crs="EPSG:4326").to_crs("EPSG:32733")
+    return Transformer.from_crs("EPSG:4326", "EPSG:32733", always_xy=True)
 
+@st.cache_resource
 def load_infrastructure():
     infra = {}
     for key, path in INFRASTRUCTURE_FILES.items():
-        gdf = gpd.read_file(path)
+        gdf = gpd.read_file(path, engine="pyogrio", use_arrow=True)
         if gdf.crs is None:
             gdf.set_crs(epsg=4326, inplace=True)
         gdf = gdf.to_crs("EPSG:32733")
         infra[key] = gdf
     return infra
 
-def compute_nearest(gdf, infra):
-    for key, gdf_infra in infra.items():
-        if gdf_infra.empty:
-            gdf[f'dist_{key}'] = np.nan
-            continue
-        gdf[f'dist_{key}'] = gdf.geometry.apply(
-            lambda geom: gdf_infra.distance(geom.centroid).min()
-        )
+def layer_files(shp_path):
+    # The .shp plus whichever sidecars (index, attributes, CRS, encoding) exist
+    base = os.path.splitext(shp_path)[0]
+    return [base + ext for ext in ('.shp', '.shx', '.dbf', '.prj', '.cpg') if os.path.exists(base + ext)]
+
+def index_cache_sources():
+    return {key: os.path.abspath(path) for key, path in INFRASTRUCTURE_FILES.items()}
+
+def read_index_cache():
+    # Stale if missing, built from other source files, or older than any dataset
+    # file. An unreadable pickle (truncated, or from other library versions,
+    # which can fail with almost any exception) is treated as missing so the
+    # indexes are simply rebuilt.
+    if not os.path.exists(INFRA_CACHE):
+        return None
+    cache_mtime = os.path.getmtime(INFRA_CACHE)
+    for shp_path in INFRASTRUCTURE_FILES.values():
+        if any(os.path.getmtime(path) > cache_mtime for path in layer_files(shp_path)):
+            return None
+    try:
+        with open(INFRA_CACHE, "rb") as f:
+            cached = pickle.load(f)
+    except Exception:
+        return None
+    if not isinstance(cached, dict) or cached.get('sources') != index_cache_sources():
+        return None
+    return cached['layers']
+
+@st.cache_resource
+def build_spatial_indexes():
+    # Point layers get a KD-tree on raw coordinates (faster than GEOS),
+    # everything else an STRtree. Empty layers have no index. The result is
+    # pickled so a restarted server skips the shapefile parse and reprojection.
+    cached = read_index_cache()
+    if cached is None:
+        cached = {}
+        for key, gdf_infra in load_infrastructure().items():
+            if gdf_infra.empty:
+                cached[key] = None
+            elif (gdf_infra.geom_type == 'Point').all():
+                cached[key] = cKDTree(np.column_stack([gdf_infra.geometry.x.values, gdf_infra.geometry.y.values]))
+            else:
+                cached[key] = shapely.to_wkb(np.asarray(gdf_infra.geometry.values))
+        # Write beside the cache and swap it in, so readers never see a partial file
+        with tempfile.NamedTemporaryFile(dir=UPLOAD_FOLDER, suffix=".pkl", delete=False) as f:
+            pickle.dump({'sources': index_cache_sources(), 'layers': cached}, f)
+        os.replace(f.name, INFRA_CACHE)
+
+    # STRtrees are stored as WKB geometries and rebuilt on load
+    return {
+        key: shapely.STRtree(shapely.from_wkb(value)) if isinstance(value, np.ndarray) else value
+        for key, value in cached.items()
+    }
+
+def candidate_points(gdf, use_bbox_centres=False):
+    geoms = np.asarray(gdf.geometry.values)
+    if use_bbox_centres:
+        # Bounding-box centre: exact for axis-aligned grid cells, and much
+        # cheaper than a true centroid because bounds need no area integration
+        b = shapely.bounds(geoms)
+        return shapely.points(0.5 * (b[:, 0] + b[:, 2]), 0.5 * (b[:, 1] + b[:, 3]))
+    return shapely.centroid(geoms)
+
+@st.cache_resource
+def layer_executor():
+    # One pool per process, one thread per layer, shared by all sessions
+    return ThreadPoolExecutor(max_workers=max(len(INFRASTRUCTURE_FILES), 1))
+
+def nearest_distances(points, tree):
+    if tree is None:
+        return np.full(len(points), np.nan)
+    if isinstance(tree, cKDTree):
+        # Empty or missing candidates have no usable coordinates (and cKDTree
+        # rejects NaN), so query only the valid rows and leave the rest NaN so
+        # they rank last. Single-threaded: layers already run in parallel.
+        nearest = np.full(len(points), np.nan)
+        valid = np.flatnonzero(~shapely.is_missing(points) & ~shapely.is_empty(points))
+        xy = np.column_stack([shapely.get_x(points[valid]), shapely.get_y(points[valid])])
+        finite = np.isfinite(xy).all(axis=1)
+        dists, _ = tree.query(xy[finite], k=1)
+        nearest[valid[finite]] = dists
+        return nearest
+    # One spatial-index query per layer instead of a distance scan per candidate.
+    # Empty points get no match, so scatter the results back by input index.
+    idx, dists = tree.query_nearest(points, return_distance=True, all_matches=False)
+    nearest = np.full(len(points), np.nan)
+    nearest[idx[0]] = dists
+    return nearest
+
+def compute_nearest(gdf, trees, use_bbox_centres=False):
+    points = candidate_points(gdf, use_bbox_centres)
+    # The layers are independent and each query runs in GEOS/scipy C code,
+    # so run them side by side rather than one after another
+    pool = layer_executor()
+    futures = {key: pool.submit(nearest_distances, points, tree) for key, tree in trees.items()}
+    for key, future in futures.items():
+        gdf[f'dist_{key}'] = future.result()
     return gdf
 
-def scoring_logic(gdf):
+def score_kernel(M):
+    # Column 0 is density (higher is better), the rest are distances (lower is
+    # better). Per-column min/max in one pass, then a broadcast normalisation.
+    mn = np.nanmin(M, axis=0)
+    mx = np.nanmax(M, axis=0)
+    norm = (M - mn) / (mx - mn + 1e-9)
+    norm[:, 1:] = 1 - norm[:, 1:]
+    return norm
+
+def scoring_logic(gdf, top_n=5):
+    if gdf.empty:
+        return gdf
+
+    # Scoring is bandwidth bound and only needs [0, 1] precision, so run it in float32
     if 'dens_sqkm' not in gdf.columns:
-        gdf['dens_sqkm'] = 1
+        gdf['dens_sqkm'] = np.float32(1)
     else:
-        gdf['dens_sqkm'] = pd.to_numeric(gdf['dens_sqkm'], errors='coerce').fillna(0)
+        gdf['dens_sqkm'] = pd.to_numeric(gdf['dens_sqkm'], errors='coerce', downcast='float').fillna(0)
 
-    gdf['dens_score'] = (gdf['dens_sqkm'] - gdf['dens_sqkm'].min()) / \
-                        (gdf['dens_sqkm'].max() - gdf['dens_sqkm'].min() + 1e-9)
+    keys = ['health', 'police', 'roads']
+    cols = ['dens_sqkm'] + [f'dist_{key}' for key in keys]
+    present = np.array([col in gdf.columns for col in cols])
+    M = np.column_stack([
+        gdf[col].to_numpy(dtype=np.float32) if col in gdf.columns else np.zeros(len(gdf), dtype=np.float32)
+        for col in cols
+    ])
 
-    for key in ['health', 'police', 'roads']:
-        dist_col = f'dist_{key}'
-        if dist_col in gdf.columns:
-            dist = gdf[dist_col]
-            gdf[f'{key}_score'] = 1 - ((dist - dist.min()) / (dist.max() - dist.min() + 1e-9))
-        else:
-            gdf[f'{key}_score'] = 0
+    norm = score_kernel(M)
+    norm[:, ~present] = 0
+
+    gdf['dens_score'] = norm[:, 0]
+    for i, key in enumerate(keys, start=1):
+        gdf[f'{key}_score'] = norm[:, i]
+    gdf['score'] = norm @ SCORE_WEIGHTS
 
-    gdf['score'] = (
-        0.4 * gdf['dens_score'] +
-        0.2 * gdf['health_score'] +
-        0.2 * gdf['police_score'] +
-        0.2 * gdf['roads_score']
-    )
+    # Partial sort: only the top_n rows need ordering (NaN scores rank last)
+    scores = gdf['score'].to_numpy()
+    k = min(top_n, len(scores))
+    idx = np.argpartition(-scores, k - 1)[:k] if 0 < k < len(scores) else np.arange(len(scores))
+    idx = idx[np.argsort(-scores[idx], kind='stable')]
+    return gdf.iloc[idx].copy()
 
-    return gdf.sort_values(by='score', ascending=False).copy()
+@st.cache_data(max_entries=16, show_spinner="Ranking candidate locations...")
+def rank_locations(zip_bytes, shp_name, use_bbox_centres, _trees):
+    # Memoised per upload: Streamlit reruns the whole script on every widget
+    # interaction (including the download button), which would otherwise
+    # repeat the full pipeline. _trees is skipped when hashing the arguments.
+
+    # Save the ZIP once and let GDAL read the shapefile from inside it. Each
+    # call gets its own file so concurrent sessions never read each other's upload.
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_FOLDER, suffix=".zip", delete=False) as f:
+        f.write(zip_bytes)
+        zip_path = os.path.abspath(f.name)
+    shp_path = f"/vsizip/{zip_path}/{shp_name}"
+    try:
+        # Only density feeds the score; pyogrio skips names missing from the file.
+        # Feature ids become the index so the ranked rows can be looked up again.
+        gdf = gpd.read_file(
+            shp_path, engine="pyogrio", use_arrow=True, columns=['dens_sqkm'], fid_as_index=True
+        )
+        if gdf.empty:
+            return gdf, False
+
+        crs_assumed = gdf.crs is None
+        if crs_assumed:
+            gdf.set_crs(epsg=4326, inplace=True)
+
+        # Project straight to UTM; no intermediate hop through EPSG:4326
+        gdf = gdf.to_crs(epsg=32733)
+
+        gdf = compute_nearest(gdf, _trees, use_bbox_centres)
+        top = scoring_logic(gdf, top_n=5)
+
+        # Read the remaining attributes (names, ids, ...) for the ranked rows only,
+        # so the download still identifies each area
+        attrs = pyogrio.read_dataframe(
+            shp_path, fids=top.index.to_numpy(), read_geometry=False, fid_as_index=True
+        )
+    finally:
+        os.remove(zip_path)
+
+    top = top.join(attrs.drop(columns=top.columns, errors='ignore'))
+    return top.to_crs("EPSG:4326"), crs_assumed
+
+# === Infrastructure (loaded once per server process) ===
+
+INFRA_TREES = build_spatial_indexes()
+UTM_TRANSFORMER = utm_transformer()
 
 # === Upload UI ===
 
 uploaded_file = st.file_uploader("Upload a zipped shapefile (.zip)", type="zip")
+use_bbox_centres = st.checkbox(
+    "Measure distances from bounding-box centres (faster; exact for rectangular grid cells)"
+)
 
 if uploaded_file:
     try:
-        # Clear previous files
-        if os.path.exists(EXTRACT_FOLDER):
-            shutil.rmtree(EXTRACT_FOLDER)
-        os.makedirs(EXTRACT_FOLDER)
-
-        # Save uploaded ZIP
-        zip_path = os.path.join(UPLOAD_FOLDER, "shapefile.zip")
-        with open(zip_path, "wb") as f:
-            f.write(uploaded_file.read())
-
-        # Extract ZIP
-        extract_zip(zip_path, EXTRACT_FOLDER)
-
-        # Find shapefile
-        shp_file = None
-        for file in os.listdir(EXTRACT_FOLDER):
-            if file.endswith('.shp'):
-                shp_file = os.path.join(EXTRACT_FOLDER, file)
-                break
-
-        if not shp_file:
+        zip_bytes = uploaded_file.read()
+        shp_name = find_shapefile(zip_bytes)
+
+        if not shp_name:
             st.error("No .shp file found in the uploaded ZIP.")
         else:
-            gdf = gpd.read_file(shp_file)
-
-            if gdf.crs is None:
-                st.warning("CRS undefined. Assuming EPSG:4326.")
-                gdf.set_crs(epsg=4326, inplace=True)
-            elif gdf.crs.to_epsg() != 4326:
-                gdf = gdf.to_crs(epsg=4326)
-
-            gdf = gdf.to_crs(epsg=32733)
-
-            # Load and process infrastructure
-            infra = load_infrastructure()
-            gdf = compute_nearest(gdf, infra)
-            gdf_scored = scoring_logic(gdf)
-            top5 = gdf_scored.head(5).to_crs("EPSG:4326")
-
-            st.success("✅ Processing complete! Showing top 5 ranked locations.")
-            st.map(top5)
-
-            # Downloadable GeoJSON
-            geojson_path = os.path.join(UPLOAD_FOLDER, "top5.geojson")
-            top5.to_file(geojson_path, driver="GeoJSON")
-            with open(geojson_path, "rb") as f:
-                st.download_button("📥 Download Top 5 as GeoJSON", f, file_name="top5.geojson", mime="application/json")
+            top5, crs_assumed = rank_locations(zip_bytes, shp_name, use_bbox_centres, INFRA_TREES)
+
+            if top5.empty:
+                st.error("The uploaded shapefile has no features.")
+            else:
+                if crs_assumed:
+                    st.warning("CRS undefined. Assuming EPSG:4326.")
+
+                st.success("✅ Processing complete! Showing top 5 ranked locations.")
+                st.map(top5)
+
+                # Downloadable GeoJSON, serialised in memory rather than via a temp file
+                st.download_button(
+                    "📥 Download Top 5 as GeoJSON", top5.to_json(), file_name="top5.geojson", mime="application/json"
+                )
 
     except Exception as e:
         st.error(f"Something went wrong: {str(e)}")